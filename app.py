@@ -1,14 +1,23 @@
 import streamlit as st
-import whisper
-import requests
+from faster_whisper import WhisperModel
+import httpx
 import json
+import re
 from datetime import datetime
 from pathlib import Path
 import io
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
+import hashlib
+import gc
+import threading
+import numpy as np
+import xlsxwriter
 import tempfile
-import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import OrderedDict
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ============ 页面配置 ============
 
@@ -51,204 +60,588 @@ if 'manual_titles' not in st.session_state:
     st.session_state.manual_titles = ""
 if 'platform_titles' not in st.session_state:
     st.session_state.platform_titles = {}
+if 'pending_batches' not in st.session_state:
+    st.session_state.pending_batches = {}
+if 'batch_results' not in st.session_state:
+    st.session_state.batch_results = {}
+if 'extract_job' not in st.session_state:
+    st.session_state.extract_job = None
+if 'extract_executor' not in st.session_state:
+    st.session_state.extract_executor = None
 
 # ============ 配置和常量 ============
 
 OPENROUTER_API_KEY = st.secrets.get("openrouter_api_key", "")
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+# 429/5xx 时指数退避重试
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = 3
+# Retry-After 等待上限（秒），避免长时间阻塞脚本线程
+RETRY_AFTER_MAX = 10
+
+WHISPER_MODEL_SIZE = "base"
+
+# Whisper 所需的输入采样率，ffmpeg 直接按此输出以省去重采样
+WHISPER_SAMPLE_RATE = 16000
+
+# 向 ffmpeg stdin 分块写入视频数据的块大小（用于统计提取进度）
+FFMPEG_CHUNK_SIZE = 1024 * 1024
+
 MODELS = {
     "deepseek": "deepseek/deepseek-r1:free",
     "mistral": "mistralai/mistral-7b-instruct"
 }
 
+# 通用标题提示词（{text} 为内容占位符）
+TITLE_PROMPT = """基于以下视频内容，生成5个吸引眼球的标题。标题要简洁有力，能吸引用户点击。
+
+视频内容：
+{text}
+
+要求：
+1. 每个标题一行
+2. 标题长度 15-30 个字
+3. 避免重复
+4. 只返回标题，不要其他解释
+
+标题列表："""
+
+# 各平台标题风格要求，单平台和全平台提示词都由此生成
+PLATFORM_SPECS = {
+    "douyin": {
+        "label": "抖音",
+        "requirements": [
+            "15秒内能讲完的爆款内容",
+            "制造悬念和FOMO感",
+            "年轻、活力的语言风格",
+            "可以使用表情符号",
+            '例如："震撼！我发现了..."、"你绝对没看过的..."'
+        ]
+    },
+    "wechat": {
+        "label": "微信视频号",
+        "requirements": [
+            "温和、专业、有信任感",
+            "包含故事感和情感连接",
+            "微信生态友好",
+            "适合各年龄段观看",
+            '例如："深度分享｜为什么..."、"这个方法改变了我..."'
+        ]
+    },
+    "xiaohongshu": {
+        "label": "小红书",
+        "requirements": [
+            "包含 # 话题标签",
+            "种草、推荐的风格",
+            "亲近感强，像朋友推荐",
+            "可以使用emoji",
+            '例如："#分享 这个真的绝了！..."、"姐妹们必看｜..."'
+        ]
+    }
+}
+
+def _format_requirements(spec):
+    """将平台要求列表格式化为提示词中的 "- " 列表"""
+    return "\n".join(f"- {item}" for item in spec["requirements"])
+
+# 平台适配提示词（{text} 为内容占位符）
+PLATFORM_PROMPTS = {
+    platform: (
+        f"根据以下内容，生成3个适合{spec['label']}的标题。\n\n"
+        f"特点要求：\n{_format_requirements(spec)}\n\n"
+        "内容：{text}\n\n"
+        "只返回标题，每行一个："
+    )
+    for platform, spec in PLATFORM_SPECS.items()
+}
+
+# 一次请求生成全部平台标题的提示词（{text} 为内容占位符）
+PLATFORM_BATCH_PROMPT = (
+    f"根据以下内容，分别为{'、'.join(spec['label'] for spec in PLATFORM_SPECS.values())}各生成3个标题。\n\n"
+    + "".join(
+        f"{spec['label']}（{platform}）特点要求：\n{_format_requirements(spec)}\n\n"
+        for platform, spec in PLATFORM_SPECS.items()
+    )
+    + "内容：{text}\n\n"
+    + "只返回一个 JSON 对象，不要其他解释，格式如下：\n"
+    + json.dumps(
+        {platform: ["标题1", "标题2", "标题3"] for platform in PLATFORM_SPECS},
+        ensure_ascii=False
+    )
+)
+
 # ============ 核心函数 ============
 
 @st.cache_resource
-def load_whisper_model():
-    """加载 Whisper 模型"""
-    return whisper.load_model("base")
+def _whisper_state():
+    """进程级 Whisper 模型单例状态（cache_resource 保证脚本重跑时不被重建）"""
+    return {"model": None, "size": None, "lock": threading.Lock()}
+
+def load_whisper_model(model_size=WHISPER_MODEL_SIZE):
+    """加载 Whisper 模型（faster-whisper / CTranslate2 int8 量化），切换大小时先释放旧模型"""
+    state = _whisper_state()
+    with state["lock"]:
+        if state["model"] is None or state["size"] != model_size:
+            if state["model"] is not None:
+                state["model"] = None
+                gc.collect()
+            state["model"] = WhisperModel(model_size, device="cpu", compute_type="int8")
+            state["size"] = model_size
+        return state["model"]
 
-def extract_audio_from_video(video_file):
-    """从视频文件提取音频"""
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tmp_video:
-            tmp_video.write(video_file.read())
-            tmp_video_path = tmp_video.name
-        
-        # 使用 ffmpeg 提取音频
-        import subprocess
-        tmp_audio_path = tmp_video_path.replace(".mp4", ".wav")
-        
-        result = subprocess.run(
-            ["ffmpeg", "-i", tmp_video_path, "-q:a", "9", "-n", tmp_audio_path],
-            capture_output=True,
-            text=True
-        )
+@st.cache_resource
+def get_http_client(api_key):
+    """创建复用连接的 HTTP/2 客户端（并发请求在同一连接上多路复用）"""
+    return httpx.Client(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=4),
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "HTTP-Referer": "https://streamlit.io",
+            "X-Title": "Video Title Generator"
+        }
+    )
+
+def _send_with_retry(data, stream=False):
+    """发送 OpenRouter 请求，连接错误、超时及 429/5xx 时指数退避重试（最多 3 次尝试）"""
+    client = get_http_client(OPENROUTER_API_KEY)
+    for attempt in range(RETRY_ATTEMPTS):
+        last_attempt = attempt == RETRY_ATTEMPTS - 1
+        delay = 2 ** attempt
         
-        if os.path.exists(tmp_audio_path):
-            return tmp_audio_path
+        request = client.build_request("POST", OPENROUTER_URL, json=data)
+        try:
+            response = client.send(request, stream=stream)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
         else:
-            st.error("❌ 音频提取失败")
-            return None
-    except Exception as e:
-        st.error(f"❌ 提取音频出错: {str(e)}")
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                return response
+            
+            response.close()
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = min(int(retry_after), RETRY_AFTER_MAX)
+        
+        time.sleep(delay)
+
+def with_script_run_ctx(func):
+    """包装 func，使其在后台线程中运行时挂载当前会话的 ScriptRunContext（cache_resource 等依赖它）"""
+    ctx = get_script_run_ctx()
+    
+    def run(*args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+    
+    return run
+
+def run_in_parallel(func, jobs, max_workers):
+    """在线程池中并行执行 func(*args)，参数相同的任务只执行一次，按提交顺序返回结果"""
+    unique_jobs = list(dict.fromkeys(jobs))
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(unique_jobs)),
+        initializer=add_script_run_ctx,
+        initargs=(None, ctx)
+    ) as pool:
+        futures = {args: pool.submit(func, *args) for args in unique_jobs}
+        return [futures[args].result() for args in jobs]
+
+def run_ffmpeg(input_args, output_args, video_buf=None, progress=None):
+    """运行 ffmpeg，将音频输出到 stdout 并返回字节；分块写入 stdin 时更新 progress["value"]"""
+    proc = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", *input_args, "-vn", *output_args, "pipe:1"],
+        stdin=subprocess.DEVNULL if video_buf is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    
+    # 单独线程读取 stdout，避免输入输出管道互相阻塞
+    output = []
+    reader = threading.Thread(target=lambda: output.append(proc.stdout.read()))
+    reader.start()
+    
+    if video_buf is not None:
+        view = memoryview(video_buf)
+        try:
+            for start in range(0, len(view), FFMPEG_CHUNK_SIZE):
+                proc.stdin.write(view[start:start + FFMPEG_CHUNK_SIZE])
+                if progress is not None:
+                    progress["value"] = min(1.0, (start + FFMPEG_CHUNK_SIZE) / len(view))
+        except BrokenPipeError:
+            # ffmpeg 提前退出（如无法从管道解析格式），由返回码判断结果
+            pass
+        finally:
+            proc.stdin.close()
+    
+    reader.join()
+    proc.stdout.close()
+    if proc.wait() != 0:
         return None
+    return output[0] or None
+
+def extract_audio_from_video(video_buf, filename, progress=None):
+    """从视频数据提取 16kHz 单声道 PCM 音频（video_buf 经 stdin 直接送入 ffmpeg），失败时抛出异常"""
+    output_args = ["-ac", "1", "-ar", str(WHISPER_SAMPLE_RATE), "-f", "s16le"]
+    
+    audio_bytes = run_ffmpeg(["-i", "pipe:0"], output_args, video_buf, progress)
+    
+    if audio_bytes is None:
+        # moov 位于文件末尾的 MP4 等格式无法从管道读取，退回临时文件
+        with tempfile.NamedTemporaryFile(suffix=Path(filename).suffix) as tmp_video:
+            tmp_video.write(video_buf)
+            tmp_video.flush()
+            audio_bytes = run_ffmpeg(["-i", tmp_video.name], output_args)
+    
+    if audio_bytes is None:
+        raise RuntimeError("音频提取失败")
+    
+    return audio_bytes
+
+class TTLCache:
+    """线程安全的有界 TTL 字典：条目超过 ttl 秒失效，超过 max_entries 时淘汰最早写入的条目"""
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """返回未过期的缓存值，未命中时返回 None"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            return value
+    
+    def set(self, key, value):
+        """写入（或覆盖）缓存值"""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.monotonic(), value)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+@st.cache_resource
+def get_transcript_cache():
+    """转录结果缓存，键为 (视频哈希, 模型大小)，24 小时有效"""
+    return TTLCache(ttl=24 * 3600, max_entries=32)
+
+def lookup_transcript(video_key):
+    """查询缓存的转录结果，未命中时返回 None"""
+    return get_transcript_cache().get((video_key, WHISPER_MODEL_SIZE))
+
+def transcribe_audio_stream(video_key, audio_bytes):
+    """使用 Whisper 逐段转录音频（16kHz 单声道 s16le PCM），完成后按视频哈希写入缓存"""
+    model = load_whisper_model(WHISPER_MODEL_SIZE)
+    audio = np.frombuffer(audio_bytes, np.int16).astype(np.float32) / 32768.0
+    segments, _ = model.transcribe(audio, language="zh", vad_filter=True)
+    
+    parts = []
+    for segment in segments:
+        parts.append(segment.text)
+        yield segment.text
+    
+    get_transcript_cache().set((video_key, WHISPER_MODEL_SIZE), "".join(parts))
+
+def get_extract_executor():
+    """当前会话的音频提取后台线程（ffmpeg 在子进程中运行，线程只负责收发数据）"""
+    if st.session_state.extract_executor is None:
+        st.session_state.extract_executor = ThreadPoolExecutor(max_workers=1)
+    return st.session_state.extract_executor
+
+def _prepare_transcription(video_buf, filename, progress):
+    """后台任务：计算视频哈希，未命中转录缓存时提取音频，返回 (video_key, 缓存文本, 音频)"""
+    video_key = hashlib.blake2b(video_buf).hexdigest()
+    cached = lookup_transcript(video_key)
+    if cached is not None:
+        return video_key, cached, None
+    
+    progress["stage"] = "extract"
+    return video_key, None, extract_audio_from_video(video_buf, filename, progress)
+
+def submit_transcription_job(video_file):
+    """提交后台音频提取任务，返回保存在 session_state 中的任务信息"""
+    progress = {"stage": "hash", "value": 0.0}
+    
+    # getbuffer() 零拷贝地暴露上传数据，哈希和 ffmpeg 共用同一份缓冲区
+    future = get_extract_executor().submit(
+        with_script_run_ctx(_prepare_transcription), video_file.getbuffer(), video_file.name, progress
+    )
+    return {"future": future, "progress": progress, "file_id": video_file.file_id}
+
+class APIStatusError(Exception):
+    """OpenRouter 返回了非 200 状态码"""
+
+class EmptyReplyError(Exception):
+    """模型返回了空内容"""
+
+def _build_request(prompt, model_name, json_mode=False, max_tokens=500, stream=False):
+    """构造 OpenRouter 请求体"""
+    data = {
+        "model": MODELS[model_name],
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.7,
+        "max_tokens": max_tokens
+    }
+    if json_mode:
+        data["response_format"] = {"type": "json_object"}
+    if stream:
+        data["stream"] = True
+    
+    return data
+
+def _request_completion(prompt, model_name, json_mode=False, max_tokens=500):
+    """向 OpenRouter 发送一次对话请求，失败时抛出异常"""
+    data = _build_request(prompt, model_name, json_mode, max_tokens)
+    response = _send_with_retry(data)
+    
+    if response.status_code != 200:
+        raise APIStatusError(response.status_code)
+    
+    result = response.json()
+    content = result["choices"][0]["message"]["content"]
+    # 空回复（如推理耗尽 max_tokens）视为失败，避免被缓存
+    if not content:
+        raise EmptyReplyError(model_name)
+    return content
+
+def _stream_completion(prompt, model_name, max_tokens=500):
+    """以 SSE 流式请求 OpenRouter，逐段产出回复内容，失败时抛出异常"""
+    data = _build_request(prompt, model_name, max_tokens=max_tokens, stream=True)
+    response = _send_with_retry(data, stream=True)
+    try:
+        if response.status_code != 200:
+            raise APIStatusError(response.status_code)
+        
+        for line in response.iter_lines():
+            # SSE 注释行（如 ": OPENROUTER PROCESSING"）和空行直接跳过
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            
+            chunk = json.loads(payload)
+            if "error" in chunk:
+                raise APIStatusError(chunk["error"].get("message", chunk["error"]))
+            
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                yield content
+    finally:
+        response.close()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_llm(prompt, model_name, json_mode=False, max_tokens=500, generation=0):
+    """按 (prompt, model, generation) 缓存模型回复，失败和空回复会抛出异常因而不会被缓存"""
+    return _request_completion(prompt, model_name, json_mode, max_tokens)
+
+@st.cache_resource
+def get_llm_generations():
+    """强制刷新计数，键为请求参数摘要；递增后旧的缓存条目不再被命中"""
+    return TTLCache(ttl=3600, max_entries=1024)
 
-def transcribe_audio(audio_path):
-    """使用 Whisper 转录音频"""
+@st.cache_resource
+def get_stream_reply_cache():
+    """流式模型回复缓存，键为 (prompt, 模型, max_tokens)，1 小时有效"""
+    return TTLCache(ttl=3600, max_entries=256)
+
+def call_openrouter_api(prompt, model_name, json_mode=False, max_tokens=500, force_refresh=False):
+    """调用 OpenRouter API（json_mode 要求模型返回 JSON 对象，force_refresh 跳过缓存）"""
     try:
-        model = load_whisper_model()
-        result = model.transcribe(audio_path, language="zh")
-        return result["text"]
+        # 强制刷新时换用新的 generation，新回复写入缓存并替换旧结果
+        generations = get_llm_generations()
+        key = hashlib.blake2b(f"{model_name}|{json_mode}|{max_tokens}|{prompt}".encode()).hexdigest()
+        generation = generations.get(key) or 0
+        if force_refresh:
+            generation += 1
+            generations.set(key, generation)
+        return _cached_llm(prompt, model_name, json_mode, max_tokens, generation)
+    except EmptyReplyError:
+        st.error("❌ 模型未返回内容")
+        return None
+    except APIStatusError as e:
+        st.error(f"❌ API 错误: {e}")
+        return None
     except Exception as e:
-        st.error(f"❌ 转录出错: {str(e)}")
+        st.error(f"❌ API 调用出错: {str(e)}")
         return None
 
-def call_openrouter_api(prompt, model_name):
-    """调用 OpenRouter API"""
+def stream_openrouter_api(prompt, model_name, max_tokens=500, force_refresh=False):
+    """流式调用 OpenRouter API，命中缓存时直接返回全文，完成后写入缓存"""
+    cache = get_stream_reply_cache()
+    key = (prompt, model_name, max_tokens)
+    content = None if force_refresh else cache.get(key)
+    if content is not None:
+        yield content
+        return
+    
+    parts = []
+    for part in _stream_completion(prompt, model_name, max_tokens):
+        parts.append(part)
+        yield part
+    
+    # 空回复（如推理耗尽 max_tokens）不写入缓存，下次点击会重新请求
+    content = "".join(parts)
+    if content:
+        cache.set(key, content)
+
+def write_openrouter_stream(prompt, model_name, max_tokens=500, force_refresh=False):
+    """流式调用 OpenRouter API 并实时渲染到页面，返回完整回复"""
     try:
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "HTTP-Referer": "https://streamlit.io",
-            "X-Title": "Video Title Generator"
-        }
-        
-        data = {
-            "model": MODELS[model_name],
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.7,
-            "max_tokens": 500
-        }
-        
-        response = requests.post(OPENROUTER_URL, json=data, headers=headers, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            st.error(f"❌ API 错误: {response.status_code}")
-            return None
+        return st.write_stream(stream_openrouter_api(prompt, model_name, max_tokens, force_refresh))
+    except APIStatusError as e:
+        st.error(f"❌ API 错误: {e}")
+        return None
     except Exception as e:
         st.error(f"❌ API 调用出错: {str(e)}")
         return None
 
-def generate_titles(text):
+def generate_titles(text, force_refresh=False):
     """生成标题 - 两个模型并行调用"""
-    prompt = f"""基于以下视频内容，生成5个吸引眼球的标题。标题要简洁有力，能吸引用户点击。
-
-视频内容：
-{text}
-
-要求：
-1. 每个标题一行
-2. 标题长度 15-30 个字
-3. 避免重复
-4. 只返回标题，不要其他解释
-
-标题列表："""
-    
-    titles_deepseek = None
-    titles_mistral = None
+    prompt = TITLE_PROMPT.replace("{text}", text)
     
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        with st.spinner("🤖 DeepSeek 生成中..."):
-            titles_deepseek = call_openrouter_api(prompt, "deepseek")
-    
-    with col2:
-        with st.spinner("🤖 Mistral 生成中..."):
-            titles_mistral = call_openrouter_api(prompt, "mistral")
+    titles_deepseek, titles_mistral = run_in_parallel(
+        partial(call_openrouter_api, force_refresh=force_refresh),
+        [(prompt, "deepseek"), (prompt, "mistral")],
+        max_workers=2
+    )
     
     return {
         "deepseek": titles_deepseek,
         "mistral": titles_mistral
     }
 
-def adapt_for_platform(text, platform):
-    """为不同平台生成适配标题"""
-    platform_prompts = {
-        "douyin": """根据以下内容，生成3个适合抖音的标题。
-        
-特点要求：
-- 15秒内能讲完的爆款内容
-- 制造悬念和FOMO感
-- 年轻、活力的语言风格
-- 可以使用表情符号
-- 例如："震撼！我发现了..."、"你绝对没看过的..."
-
-内容：{text}
+@st.cache_resource
+def get_batch_executor():
+    """批量队列使用的后台线程池（跨脚本重跑复用）"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def submit_batch(prompts, model):
+    """将一批提示词提交到后台队列（重复的提示词只请求一次），返回批次 ID"""
+    batch_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    executor = get_batch_executor()
+    request_completion = with_script_run_ctx(_request_completion)
+    futures = {
+        prompt: executor.submit(request_completion, prompt, model)
+        for prompt in dict.fromkeys(prompts)
+    }
+    st.session_state.pending_batches[batch_id] = {
+        "model": model,
+        "futures": [futures[prompt] for prompt in prompts]
+    }
+    return batch_id
 
-只返回标题，每行一个：""",
+def poll_batches():
+    """收取已全部完成的批次结果，每次脚本重跑时调用"""
+    for batch_id, batch in list(st.session_state.pending_batches.items()):
+        if not all(future.done() for future in batch["futures"]):
+            continue
         
-        "wechat": """根据以下内容，生成3个适合微信视频号的标题。
-
-特点要求：
-- 温和、专业、有信任感
-- 包含故事感和情感连接
-- 微信生态友好
-- 适合各年龄段观看
-- 例如："深度分享｜为什么..."、"这个方法改变了我..."
-
-内容：{text}
-
-只返回标题，每行一个：""",
+        items = []
+        for future in batch["futures"]:
+            try:
+                items.append({"titles": future.result(), "error": None})
+            except Exception as e:
+                items.append({"titles": None, "error": str(e)})
         
-        "xiaohongshu": """根据以下内容，生成3个适合小红书的标题。
-
-特点要求：
-- 包含 # 话题标签
-- 种草、推荐的风格
-- 亲近感强，像朋友推荐
-- 可以使用emoji
-- 例如："#分享 这个真的绝了！..."、"姐妹们必看｜..."
-
-内容：{text}
-
-只返回标题，每行一个："""
+        st.session_state.batch_results[batch_id] = {"model": batch["model"], "items": items}
+        del st.session_state.pending_batches[batch_id]
+
+def adapt_for_platform(text, platform, force_refresh=False):
+    """为不同平台生成适配标题（流式渲染到当前位置）"""
+    prompt = PLATFORM_PROMPTS.get(platform, "").replace("{text}", text)
+    return write_openrouter_stream(prompt, "mistral", force_refresh=force_refresh)
+
+def parse_platform_titles(content):
+    """解析多平台标题回复：优先按 JSON 解析，失败时按平台名称正则切分"""
+    platforms = ["douyin", "wechat", "xiaohongshu"]
+    
+    start, end = content.find("{"), content.rfind("}")
+    if start != -1 and end > start:
+        try:
+            parsed = json.loads(content[start:end + 1])
+        except json.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, dict):
+            results = {}
+            for platform in platforms:
+                titles = parsed.get(platform)
+                if isinstance(titles, list):
+                    titles = "\n".join(str(title).strip() for title in titles if str(title).strip())
+                if titles:
+                    results[platform] = str(titles).strip()
+            if results:
+                return results
+    
+    aliases = {
+        "douyin": "douyin", "抖音": "douyin",
+        "wechat": "wechat", "视频号": "wechat",
+        "xiaohongshu": "xiaohongshu", "小红书": "xiaohongshu"
     }
-    
-    prompt = platform_prompts.get(platform, "").format(text=text)
-    return call_openrouter_api(prompt, "mistral")
+    # 标题行只能是平台名本身（可带 **、编号符号、版本、冒号等），避免吞掉 "#小红书必看" 这类话题标签标题
+    parts = re.split(
+        r"^[^\w\n]*(douyin|wechat|xiaohongshu|抖音|视频号|小红书)(?:版本|版)?[^\w\n]*$",
+        content,
+        flags=re.MULTILINE
+    )
+    results = {}
+    for name, body in zip(parts[1::2], parts[2::2]):
+        if body.strip():
+            results[aliases[name]] = body.strip()
+    return results
+
+def adapt_for_all_platforms(text, force_refresh=False):
+    """一次请求同时生成三个平台的适配标题"""
+    prompt = PLATFORM_BATCH_PROMPT.replace("{text}", text)
+    content = call_openrouter_api(
+        prompt, "mistral", json_mode=True, max_tokens=1000, force_refresh=force_refresh
+    )
+    if not content:
+        return {}
+    return parse_platform_titles(content)
 
 def create_excel_file(original_text, manual_titles, platform_results):
-    """创建 Excel 文件"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "视频标题"
+    """创建 Excel 文件（xlsxwriter constant_memory 模式逐行写入）"""
+    output = io.BytesIO()
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+    ws = wb.add_worksheet("视频标题")
     
     # 设置列宽
-    ws.column_dimensions['A'].width = 20
-    ws.column_dimensions['B'].width = 50
+    ws.set_column("A:A", 20)
+    ws.set_column("B:B", 50)
     
     # 样式
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF")
+    header_format = wb.add_format({"bg_color": "#4472C4", "font_color": "white", "bold": True})
+    wrap_format = wb.add_format({"text_wrap": True})
     
     # 标题行
-    ws['A1'] = "内容类型"
-    ws['B1'] = "标题"
-    ws['A1'].fill = header_fill
-    ws['B1'].fill = header_fill
-    ws['A1'].font = header_font
-    ws['B1'].font = header_font
+    ws.write_string(0, 0, "内容类型", header_format)
+    ws.write_string(0, 1, "标题", header_format)
     
-    row = 2
+    # 文本一律用 write_string 写入，避免以 http(s):// 开头的内容被识别为超链接
+    row = 1
     
     # 原始转录文本
-    ws[f'A{row}'] = "原始转录文本"
-    ws[f'B{row}'] = original_text
-    ws[f'B{row}'].alignment = Alignment(wrap_text=True)
+    ws.write_string(row, 0, "原始转录文本")
+    ws.write_string(row, 1, original_text, wrap_format)
     row += 1
     
     # 手动输入的标题
     if manual_titles.strip():
-        ws[f'A{row}'] = "手动输入标题"
-        ws[f'B{row}'] = manual_titles
-        ws[f'B{row}'].alignment = Alignment(wrap_text=True)
+        ws.write_string(row, 0, "手动输入标题")
+        ws.write_string(row, 1, manual_titles, wrap_format)
         row += 1
     
     # 平台适配标题
@@ -260,14 +653,12 @@ def create_excel_file(original_text, manual_titles, platform_results):
     
     for platform_key, platform_name in platform_names.items():
         if platform_key in platform_results and platform_results[platform_key]:
-            ws[f'A{row}'] = platform_name
-            ws[f'B{row}'] = platform_results[platform_key]
-            ws[f'B{row}'].alignment = Alignment(wrap_text=True)
+            ws.write_string(row, 0, platform_name)
+            ws.write_string(row, 1, platform_results[platform_key], wrap_format)
             row += 1
     
     # 保存到字节流
-    output = io.BytesIO()
-    wb.save(output)
+    wb.close()
     output.seek(0)
     return output
 
@@ -289,19 +680,47 @@ video_file = st.file_uploader(
     type=["mp4", "mov", "mkv", "avi", "webm", "flv"]
 )
 
+# 上传文件被移除或更换后，丢弃旧文件的提取任务，避免把旧视频的转录写入新视频
+if st.session_state.extract_job and (
+    video_file is None or st.session_state.extract_job["file_id"] != video_file.file_id
+):
+    st.session_state.extract_job["future"].cancel()
+    st.session_state.extract_job = None
+
 if video_file:
     st.info(f"📄 已选择：{video_file.name}")
     
     if st.button("🎙️ 开始转录", key="transcribe_btn"):
-        with st.spinner("正在提取音频..."):
-            audio_path = extract_audio_from_video(video_file)
+        st.session_state.extract_job = submit_transcription_job(video_file)
+    
+    # 任务保存在 session_state 中：每次运行只检查一次，未完成时在页面末尾定时重跑
+    job = st.session_state.extract_job
+    if job and not job["future"].done():
+        stage_text = {"hash": "正在计算文件指纹...", "extract": "正在提取音频..."}
+        progress = job["progress"]
+        st.progress(progress["value"], text=stage_text[progress["stage"]])
+    elif job:
+        future = job["future"]
+        st.session_state.extract_job = None
+        
+        transcribed = None
+        try:
+            video_key, transcribed, audio_bytes = future.result()
+        except Exception as e:
+            st.error(f"❌ 提取音频出错: {str(e)}")
+            audio_bytes = None
         
-        if audio_path:
-            with st.spinner("正在转录语音..."):
-                transcribed = transcribe_audio(audio_path)
-                if transcribed:
-                    st.session_state.transcribed_text = transcribed
-                    st.success("✅ 转录完成！")
+        if audio_bytes:
+            try:
+                with st.spinner("正在转录语音..."):
+                    transcribed = st.write_stream(transcribe_audio_stream(video_key, audio_bytes))
+            except Exception as e:
+                st.error(f"❌ 转录出错: {str(e)}")
+                transcribed = None
+        
+        if transcribed:
+            st.session_state.transcribed_text = transcribed
+            st.success("✅ 转录完成！")
 
 # 第二步：文本编辑
 st.markdown("### ✏️ 第二步：文本编辑和优化")
@@ -328,18 +747,29 @@ if edited_text:
         if st.button("✨ 自动整理", use_container_width=True):
             st.info("功能开发中...")
 
+# 转录文本在本次运行中不再变化，只做一次 strip 判断供后续各步骤复用
+has_text = bool(st.session_state.transcribed_text.strip())
+
 # 第三步：标题生成
 st.markdown("### 🎯 第三步：标题生成（两个模型）")
 
+force_refresh = st.checkbox(
+    "🔄 忽略缓存重新生成",
+    key="force_refresh",
+    help="默认复用相同内容的生成结果（1 小时内有效），勾选后重新请求模型，新结果会替换之前的缓存"
+)
+
 if st.button("🚀 生成标题", key="generate_btn", type="primary"):
-    if not st.session_state.transcribed_text.strip():
+    if not has_text:
         st.error("❌ 请先输入或转录文本内容")
     else:
         if not OPENROUTER_API_KEY:
             st.error("❌ 未设置 OpenRouter API Key，请在 Streamlit Secrets 中配置")
         else:
-            with st.spinner("正在生成标题..."):
-                st.session_state.generated_titles = generate_titles(st.session_state.transcribed_text)
+            with st.spinner("🤖 DeepSeek 与 Mistral 并行生成中..."):
+                st.session_state.generated_titles = generate_titles(
+                    st.session_state.transcribed_text, force_refresh=force_refresh
+                )
 
 # 显示生成的标题
 if st.session_state.generated_titles:
@@ -361,6 +791,45 @@ if st.session_state.generated_titles:
         else:
             st.warning("生成失败")
 
+# 队列批量生成
+poll_batches()
+
+with st.expander("📦 队列批量生成（多个视频）"):
+    batch_text = st.text_area(
+        "每个视频的内容之间用单独一行 --- 分隔",
+        height=150,
+        key="batch_text_input"
+    )
+    batch_model = st.selectbox("使用模型", list(MODELS.keys()), key="batch_model")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("📥 加入批量队列", use_container_width=True):
+            texts = [t.strip() for t in re.split(r"^\s*-{3,}\s*$", batch_text, flags=re.MULTILINE) if t.strip()]
+            if not texts:
+                st.error("❌ 请先输入文本")
+            elif not OPENROUTER_API_KEY:
+                st.error("❌ 未设置 OpenRouter API Key，请在 Streamlit Secrets 中配置")
+            else:
+                prompts = [TITLE_PROMPT.replace("{text}", t) for t in texts]
+                batch_id = submit_batch(prompts, batch_model)
+                st.success(f"✅ 已加入队列：{batch_id}（{len(prompts)} 个视频）")
+    with col2:
+        if st.button("🔄 刷新队列状态", use_container_width=True):
+            st.rerun()
+    
+    if st.session_state.pending_batches:
+        st.info(f"⏳ 处理中的批次：{len(st.session_state.pending_batches)} 个")
+    
+    for batch_id, batch in st.session_state.batch_results.items():
+        st.markdown(f"**批次 {batch_id}（{batch['model']}）**")
+        for i, item in enumerate(batch["items"], 1):
+            if item["titles"]:
+                st.markdown(f"视频 {i}：")
+                st.write(item["titles"])
+            else:
+                st.warning(f"视频 {i} 生成失败：{item['error']}")
+
 # 第四步：平台适配
 st.markdown("### 📱 第四步：平台适配标题生成")
 
@@ -373,40 +842,60 @@ manual_titles_input = st.text_area(
 if manual_titles_input:
     st.session_state.manual_titles = manual_titles_input
 
+if st.button("🚀 生成全部平台", key="generate_all_platforms_btn", type="primary", use_container_width=True):
+    if not has_text:
+        st.error("❌ 请先输入文本")
+    else:
+        with st.spinner("三个平台一次性生成中..."):
+            results = adapt_for_all_platforms(
+                st.session_state.transcribed_text, force_refresh=force_refresh
+            )
+        if results:
+            st.session_state.platform_titles.update(results)
+            st.rerun()
+        else:
+            st.warning("生成失败")
+
 col1, col2, col3 = st.columns(3)
 
 with col1:
     if st.button("📱 生成抖音版本", use_container_width=True):
-        if not st.session_state.transcribed_text.strip():
+        if not has_text:
             st.error("❌ 请先输入文本")
         else:
             with st.spinner("生成中..."):
-                result = adapt_for_platform(st.session_state.transcribed_text, "douyin")
+                result = adapt_for_platform(
+                    st.session_state.transcribed_text, "douyin", force_refresh=force_refresh
+                )
                 if result:
                     st.session_state.platform_titles["douyin"] = result
-                    st.success("✅ 完成")
+                    st.rerun()
 
 with col2:
     if st.button("📱 生成视频号版本", use_container_width=True):
-        if not st.session_state.transcribed_text.strip():
+        if not has_text:
             st.error("❌ 请先输入文本")
         else:
             with st.spinner("生成中..."):
-                result = adapt_for_platform(st.session_state.transcribed_text, "wechat")
+                result = adapt_for_platform(
+                    st.session_state.transcribed_text, "wechat", force_refresh=force_refresh
+                )
                 if result:
                     st.session_state.platform_titles["wechat"] = result
-                    st.success("✅ 完成")
+                    st.rerun()
 
 with col3:
     if st.button("📱 生成小红书版本", use_container_width=True):
-        if not st.session_state.transcribed_text.strip():
+        if not has_text:
             st.error("❌ 请先输入文本")
         else:
             with st.spinner("生成中..."):
-                result = adapt_for_platform(st.session_state.transcribed_text, "xiaohongshu")
+                result = adapt_for_platform(
+                    st.session_state.transcribed_text, "xiaohongshu", force_refresh=force_refresh
+                )
                 if result:
                     st.session_state.platform_titles["xiaohongshu"] = result
-                    st.success("✅ 完成")
+                    st.rerun()
 
 # 显示平台标题
 if st.session_state.platform_titles:
@@ -433,7 +922,7 @@ if st.session_state.platform_titles:
 st.markdown("### 📊 第五步：导出结果")
 
 if st.button("💾 导出为 Excel", type="primary", use_container_width=True):
-    if not st.session_state.transcribed_text.strip():
+    if not has_text:
         st.error("❌ 没有转录文本")
     else:
         excel_file = create_excel_file(
@@ -485,7 +974,7 @@ with st.sidebar:
     - 亲近感强
     
     ### 技术栈
-    - **语音识别**：OpenAI Whisper
+    - **语音识别**：faster-whisper (Whisper int8)
     - **AI 模型**：OpenRouter (DeepSeek + Mistral)
     - **前端框架**：Streamlit
     - **导出格式**：Excel
@@ -519,3 +1008,8 @@ st.markdown("""
     <p>🎬 AI 视频标题生成工具 Pro | 完全免费 | Powered by Streamlit + OpenRouter</p>
 </div>
 """, unsafe_allow_html=True)
+
+# 后台音频提取结果尚未收取时，等页面渲染完毕后稍候重跑以刷新进度或收取结果
+if st.session_state.extract_job:
+    time.sleep(0.5)
+    st.rerun()